@@ -4,27 +4,35 @@ import os
 import io
 import re
 import math
-from typing import List, Dict, Any, Tuple, Optional
+import hashlib
+import threading
+import itertools
+import importlib
+import importlib.util
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Tuple, Optional, Iterator, Union
 
 import google.generativeai as genai
 
-# Optional parsers for document handling
 try:
-    import PyPDF2
+    import diskcache
 except Exception:
-    PyPDF2 = None
+    diskcache = None
 
 try:
-    import docx2txt
+    import ahocorasick
 except Exception:
-    docx2txt = None
+    ahocorasick = None
 
 try:
-    import pandas as pd
+    from cachetools import TTLCache
 except Exception:
-    pd = None
+    TTLCache = None
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ----------------------------
 # Environment / API setup
@@ -41,18 +49,99 @@ if GEMINI_API_KEY:
 else:
     _MODEL = None
 
-def _gen(prompt: str) -> str:
-    """Call Gemini safely and return response text or a graceful message."""
+# Response cache keyed by prompt hash: in-memory LRU, then on-disk (optional) so
+# repeat prompts survive Streamlit restarts. Errors are never cached.
+_MEM_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_MEM_CACHE_MAX = 512
+_MEM_LOCK = threading.Lock()
+
+# Upper bound on concurrent blocking Gemini calls across all thread pools
+GEN_MAX_CONCURRENCY = 8
+_GEN_SLOTS = threading.BoundedSemaphore(GEN_MAX_CONCURRENCY)
+
+try:
+    _DISK_CACHE = diskcache.Cache(os.getenv("GEMINI_CACHE_DIR", "/tmp/gemini_cache")) if diskcache else None
+except Exception:
+    _DISK_CACHE = None
+
+def _cache_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+def _cache_get(key: str) -> Optional[str]:
+    with _MEM_LOCK:
+        if key in _MEM_CACHE:
+            _MEM_CACHE.move_to_end(key)
+            return _MEM_CACHE[key]
+    if _DISK_CACHE is not None:
+        try:
+            text = _DISK_CACHE.get(key)
+        except Exception:
+            text = None
+        if text is not None:
+            _cache_put(key, text, disk=False)
+            return text
+    return None
+
+def _cache_put(key: str, text: str, disk: bool = True) -> None:
+    if not text:
+        return
+    with _MEM_LOCK:
+        _MEM_CACHE[key] = text
+        _MEM_CACHE.move_to_end(key)
+        while len(_MEM_CACHE) > _MEM_CACHE_MAX:
+            _MEM_CACHE.popitem(last=False)
+    if disk and _DISK_CACHE is not None:
+        try:
+            _DISK_CACHE[key] = text
+        except Exception:
+            pass
+
+def _gen_stream(prompt: str, key: str) -> Iterator[str]:
+    """Yield Gemini response chunks as they arrive; cache the full text once complete."""
+    parts: List[str] = []
+    try:
+        for chunk in _MODEL.generate_content(prompt, stream=True):
+            piece = getattr(chunk, "text", "") or ""
+            if piece:
+                parts.append(piece)
+                yield piece
+    except Exception as e:
+        yield f"\n\n⚠️ Gemini error: {e}" if parts else f"⚠️ Gemini error: {e}"
+        return
+    _cache_put(key, "".join(parts).strip())
+
+_GEN_OFFLINE_MSG = (
+    "💡 (Gemini not configured) I can still help with offline checks. "
+    "For richer answers, set GEMINI_API_KEY in your environment."
+)
+
+def is_gen_failure(text: str) -> bool:
+    """True if text is _gen's offline/error message rather than a model reply."""
+    return text.startswith(("⚠️ Gemini error", _GEN_OFFLINE_MSG))
+
+def _gen(prompt: str, stream: bool = False) -> Union[str, Iterator[str]]:
+    """
+    Call Gemini safely and return response text or a graceful message.
+    With stream=True, returns an iterator of text chunks instead (a cached reply
+    is yielded as one chunk).
+    """
     if not _MODEL:
-        return (
-            "💡 (Gemini not configured) I can still help with offline checks. "
-            "For richer answers, set GEMINI_API_KEY in your environment."
-        )
+        return iter([_GEN_OFFLINE_MSG]) if stream else _GEN_OFFLINE_MSG
+    key = _cache_key(prompt)
+    cached = _cache_get(key)
+    if cached is not None:
+        return iter([cached]) if stream else cached
+    if stream:
+        return _gen_stream(prompt, key)
     try:
-        resp = _MODEL.generate_content(prompt)
-        return (resp.text or "").strip()
+        # Nested summary pools (per file × per chunk) share this global cap
+        with _GEN_SLOTS:
+            resp = _MODEL.generate_content(prompt)
+        text = (resp.text or "").strip()
     except Exception as e:
         return f"⚠️ Gemini error: {e}"
+    _cache_put(key, text)
+    return text
 
 # ----------------------------
 # Minimal port DB + geometry
@@ -69,8 +158,7 @@ PORTS: Dict[str, Tuple[float, float]] = {
     "cape town": (-33.92, 18.44),
 }
 
-def haversine_nm(lat1, lon1, lat2, lon2) -> float:
-    """Great-circle distance in nautical miles."""
+def _haversine_nm_py(lat1, lon1, lat2, lon2) -> float:
     R_km = 6371.0
     R_nm = R_km * 0.539957
     phi1, phi2 = math.radians(lat1), math.radians(lat2)
@@ -80,6 +168,64 @@ def haversine_nm(lat1, lon1, lat2, lon2) -> float:
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
     return R_nm * c
 
+_haversine_impl = _haversine_nm_py
+
+def _load_haversine() -> None:
+    """Import Numba and compile (disk-cached); swapped in only once warmed up.
+    Runs in a background thread so neither import nor the first query waits on it."""
+    global _haversine_impl
+    try:
+        from numba import njit
+        jitted = njit(cache=True, fastmath=True)(_haversine_nm_py)
+        jitted(0.0, 0.0, 1.0, 1.0)
+        _haversine_impl = jitted
+    except Exception:
+        pass
+
+threading.Thread(target=_load_haversine, name="haversine-jit", daemon=True).start()
+
+def haversine_nm(lat1, lon1, lat2, lon2) -> float:
+    """Great-circle distance in nautical miles (plain Python until the JIT warm-up finishes)."""
+    return _haversine_impl(lat1, lon1, lat2, lon2)
+
+# ----------------------------
+# Precompiled query patterns
+# ----------------------------
+_RE_DIST1 = re.compile(r"distance.*?(?:between|from)\s+([a-z\s]+?)\s+(?:and|to)\s+([a-z\s]+)")
+_RE_DIST2 = re.compile(r"([a-z\s]+?)\s+(?:to|->|→)\s+([a-z\s]+)")
+_RE_WX_IN = re.compile(r"(?:in|at)\s+([a-zA-Z\s\-]+)$", re.IGNORECASE)
+_RE_TOK = re.compile(r"[^A-Za-z\-]+")
+# Tolerates markdown decoration around the marker, e.g. "**=== FILE: a.pdf ===**"
+_RE_BATCH_FILE = re.compile(
+    r"^[\s*#_]*=== FILE:\s*(.+?)\s*===[\s*_]*$(.*?)(?=^[\s*#_]*=== FILE:|\Z)", re.M | re.S
+)
+
+# Port coordinates as contiguous arrays for vectorized distance queries (built on first use)
+_PORT_NAMES: List[str] = list(PORTS)
+_PORT_ARRAYS = None
+
+def haversine_nm_batch(lat0, lon0):
+    """
+    Great-circle distance in nautical miles from (lat0, lon0) to every port in PORTS.
+    Returns an array aligned with _PORT_NAMES (requires NumPy).
+    """
+    global _PORT_ARRAYS
+    np = _optional_import("numpy")
+    if np is None:
+        raise RuntimeError("NumPy is required for haversine_nm_batch")
+    if _PORT_ARRAYS is None:
+        _PORT_ARRAYS = (
+            np.array([c[0] for c in PORTS.values()], dtype=np.float64),
+            np.array([c[1] for c in PORTS.values()], dtype=np.float64),
+        )
+    port_lats, port_lons = _PORT_ARRAYS
+    phi0 = np.radians(lat0)
+    phi = np.radians(port_lats)
+    dphi = phi - phi0
+    dlmb = np.radians(port_lons - lon0)
+    a = np.sin(dphi/2)**2 + np.cos(phi0)*np.cos(phi)*np.sin(dlmb/2)**2
+    return 6371.0 * 0.539957 * 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
 def parse_distance_query(q: str) -> Tuple[str, str]:
     """
     Extract origin & destination from text like:
@@ -88,17 +234,69 @@ def parse_distance_query(q: str) -> Tuple[str, str]:
     Returns (origin, destination) in lowercase if found, else ("","").
     """
     ql = q.lower()
-    m = re.search(r"distance.*?(?:between|from)\s+([a-z\s]+?)\s+(?:and|to)\s+([a-z\s]+)", ql)
+    m = _RE_DIST1.search(ql)
     if m:
         return m.group(1).strip(), m.group(2).strip()
-    m2 = re.search(r"([a-z\s]+?)\s+(?:to|->|→)\s+([a-z\s]+)", ql)
+    m2 = _RE_DIST2.search(ql)
     if m2:
         return m2.group(1).strip(), m2.group(2).strip()
     return "", ""
 
+# ----------------------------
+# Intent keyword matcher (single pass over the message)
+# ----------------------------
+_KEYWORDS: List[Tuple[str, str]] = [
+    ("weather", "wx"),
+    ("forecast", "wx"),
+    ("distance", "dist"),
+    *((p, "port") for p in PORTS),
+]
+
+if ahocorasick is not None:
+    _AC = ahocorasick.Automaton()
+    for _kw, _tag in _KEYWORDS:
+        _AC.add_word(_kw, (_tag, _kw))
+    _AC.make_automaton()
+else:
+    _AC = None
+
+def scan_keywords(ql: str) -> Tuple[set, List[Tuple[int, str]]]:
+    """
+    Scan a lowercased message once for intent keywords and port names.
+    Returns (intent tags, [(start, port)] in order of appearance). Overlapping port
+    hits resolve longest-first, so multi-word names aren't shadowed by shorter ones.
+    """
+    if _AC is not None:
+        hits = [(end - len(kw) + 1, tag, kw) for end, (tag, kw) in _AC.iter(ql)]
+    else:
+        hits = []
+        for kw, tag in _KEYWORDS:
+            i = ql.find(kw)
+            while i != -1:
+                hits.append((i, tag, kw))
+                i = ql.find(kw, i + 1)
+    tags = {tag for _, tag, _ in hits}
+    ports: List[Tuple[int, str]] = []
+    for start, _, kw in sorted((h for h in hits if h[1] == "port"), key=lambda h: (-len(h[2]), h[0])):
+        end = start + len(kw)
+        if all(end <= i or start >= i + len(p) for i, p in ports):
+            ports.append((start, kw))
+    ports.sort()
+    return tags, ports
+
 # ----------------------------
 # Documents: read & summarize
 # ----------------------------
+def _optional_import(name: str):
+    """Import a parser on first use (keeps pandas & co. off the UI cold-start path)."""
+    try:
+        return importlib.import_module(name)
+    except Exception:
+        return None
+
+TABLE_PREVIEW_ROWS = 50
+_PDFIUM_LOCK = threading.Lock()
+
 def read_text_from_file(file_name: str, file_bytes: bytes) -> str:
     ext = os.path.splitext(file_name)[1].lower()
 
@@ -108,37 +306,63 @@ def read_text_from_file(file_name: str, file_bytes: bytes) -> str:
         except Exception:
             return file_bytes.decode("latin-1", errors="ignore")
 
-    if ext == ".pdf" and PyPDF2:
-        try:
-            text = []
-            with io.BytesIO(file_bytes) as f:
-                pdf = PyPDF2.PdfReader(f)
-                for page in pdf.pages:
-                    text.append(page.extract_text() or "")
-            return "\n".join(text).strip()
-        except Exception as e:
-            return f"PDF read error: {e}"
-
-    if ext == ".docx" and docx2txt:
-        try:
-            import tempfile
-            with tempfile.NamedTemporaryFile(suffix=".docx", delete=False) as tmp:
-                tmp.write(file_bytes)
-                tmp.flush()
-                content = docx2txt.process(tmp.name) or ""
-            return content.strip()
-        except Exception as e:
-            return f"DOCX read error: {e}"
-
-    if ext in (".csv", ".xlsx") and pd is not None:
-        try:
-            if ext == ".csv":
-                df = pd.read_csv(io.BytesIO(file_bytes))
-            else:
-                df = pd.read_excel(io.BytesIO(file_bytes))
-            return df.head(50).to_string(index=False)
-        except Exception as e:
-            return f"Table read error: {e}"
+    if ext == ".pdf":
+        pdfium = _optional_import("pypdfium2")
+        PyPDF2 = None if pdfium is not None else _optional_import("PyPDF2")
+        if pdfium is not None:
+            try:
+                # PDFium is not thread-safe; serialize all calls into it
+                with _PDFIUM_LOCK:
+                    pdf = pdfium.PdfDocument(file_bytes)
+                    try:
+                        text = []
+                        for page in pdf:
+                            textpage = page.get_textpage()
+                            text.append(textpage.get_text_range() or "")
+                            textpage.close()
+                            page.close()
+                    finally:
+                        pdf.close()
+                return "\n".join(text).strip()
+            except Exception as e:
+                PyPDF2 = _optional_import("PyPDF2")
+                if not PyPDF2:
+                    return f"PDF read error: {e}"
+
+        # Fallback PDF parser (slower) if pypdfium2 is missing or failed
+        if PyPDF2:
+            try:
+                text = []
+                with io.BytesIO(file_bytes) as f:
+                    pdf = PyPDF2.PdfReader(f)
+                    for page in pdf.pages:
+                        text.append(page.extract_text() or "")
+                return "\n".join(text).strip()
+            except Exception as e:
+                return f"PDF read error: {e}"
+
+    if ext == ".docx":
+        docx2txt = _optional_import("docx2txt")
+        if docx2txt:
+            try:
+                content = docx2txt.process(io.BytesIO(file_bytes)) or ""
+                return content.strip()
+            except Exception as e:
+                return f"DOCX read error: {e}"
+
+    if ext in (".csv", ".xlsx"):
+        pd = _optional_import("pandas")
+        if pd is not None:
+            try:
+                # Only read the rows we preview
+                if ext == ".csv":
+                    df = pd.read_csv(io.BytesIO(file_bytes), nrows=TABLE_PREVIEW_ROWS)
+                else:
+                    engine = "calamine" if importlib.util.find_spec("python_calamine") else None
+                    df = pd.read_excel(io.BytesIO(file_bytes), nrows=TABLE_PREVIEW_ROWS, engine=engine)
+                return df.head(TABLE_PREVIEW_ROWS).to_string(index=False)
+            except Exception as e:
+                return f"Table read error: {e}"
 
     return "Unsupported file type or missing parser. Try .txt, .pdf, .docx, .csv, or .xlsx."
 
@@ -149,19 +373,96 @@ When summarizing docs, extract key terms, obligations, time bars, and demurrage
 Use bullet points & short sections.
 """
 
+# What every document summary should cover (single, batch, and map-reduce prompts)
+SUMMARY_FIELDS = """- Document type & scope
+- Parties, dates, ports
+- Key obligations & time bars
+- Laytime & demurrage terms (if any)
+- Risks & recommended actions
+"""
+
+# Approximate tokenization (~4 chars/token) for long-document map-reduce
+CHARS_PER_TOKEN = 4
+CHUNK_TOKENS = 8000
+# Single-call budget: longer documents are map-reduced instead of clipped
+SINGLE_CALL_CHARS = CHUNK_TOKENS * CHARS_PER_TOKEN
+
+def _chunks(text: str, tok: int = CHUNK_TOKENS) -> List[str]:
+    step = tok * CHARS_PER_TOKEN
+    return [text[i:i+step] for i in range(0, len(text), step)]
+
+def _summarize_long_document(doc_text: str) -> str:
+    """Map: summarize each ~CHUNK_TOKENS chunk in parallel. Reduce: merge the partial summaries."""
+    chunks = _chunks(doc_text)
+    n = len(chunks)
+    prompts = [
+        f"{SYSTEM_STYLE}\n"
+        f"This is part {i} of {n} of a longer maritime document. Summarize this part, keeping:\n"
+        f"- Parties, dates, ports\n"
+        f"- Obligations, time bars, laytime & demurrage terms\n"
+        f"- Risks\n\n"
+        f"--- PART {i} START ---\n{chunk}\n--- PART {i} END ---"
+        for i, chunk in enumerate(chunks, 1)
+    ]
+    with ThreadPoolExecutor(max_workers=min(GEN_MAX_CONCURRENCY, n)) as ex:
+        partials = list(ex.map(_gen, prompts))
+    joined = "\n\n".join(f"### Part {i}\n{p}" for i, p in enumerate(partials, 1))
+    prompt = (
+        f"{SYSTEM_STYLE}\n"
+        f"Below are summaries of consecutive parts of one maritime document. "
+        f"Merge them into a single summary. Extract:\n{SUMMARY_FIELDS}\n"
+        f"--- PART SUMMARIES START ---\n{joined}\n--- PART SUMMARIES END ---"
+    )
+    return _gen(prompt)
+
 def summarize_document(doc_text: str) -> str:
+    if len(doc_text) > SINGLE_CALL_CHARS:
+        return _summarize_long_document(doc_text)
     prompt = (
         f"{SYSTEM_STYLE}\n"
-        f"Summarize the following maritime document. Extract:\n"
-        f"- Document type & scope\n"
-        f"- Parties, dates, ports\n"
-        f"- Key obligations & time bars\n"
-        f"- Laytime & demurrage terms (if any)\n"
-        f"- Risks & recommended actions\n\n"
-        f"--- DOCUMENT START ---\n{doc_text[:15000]}\n--- DOCUMENT END ---"
+        f"Summarize the following maritime document. Extract:\n{SUMMARY_FIELDS}\n"
+        f"--- DOCUMENT START ---\n{doc_text}\n--- DOCUMENT END ---"
     )
     return _gen(prompt)
 
+BATCH_DOC_CHARS = 6000
+
+def summarize_documents_batch(docs: Dict[str, str]) -> Dict[str, str]:
+    """
+    Summarize several documents in a single Gemini call.
+    Each document is clipped to BATCH_DOC_CHARS; the reply is split back per file
+    on '=== FILE: <name> ===' markers. Files missing from the reply are summarized
+    individually (in parallel). If the batch call itself fails, every file maps to
+    that error message.
+    """
+    if not docs:
+        return {}
+    parts = [
+        f"{SYSTEM_STYLE}\n"
+        f"Summarize each of the following maritime documents. For each, extract:\n{SUMMARY_FIELDS}\n"
+        f"Output strictly as:\n=== FILE: <name> ===\n<summary>\n\n"
+    ]
+    for fname, txt in docs.items():
+        parts.append(f"=== FILE: {fname} ===\n{txt[:BATCH_DOC_CHARS]}\n")
+    reply = _gen("\n".join(parts))
+
+    # A failed batch call would fail per file too; report it instead of retrying N times
+    if is_gen_failure(reply):
+        return {fname: reply for fname in docs}
+
+    summaries: Dict[str, str] = {}
+    for m in _RE_BATCH_FILE.finditer(reply):
+        name = m.group(1).strip()
+        if name in docs:
+            summaries[name] = m.group(2).strip()
+
+    missing = [fname for fname in docs if fname not in summaries]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(GEN_MAX_CONCURRENCY, len(missing))) as ex:
+            for fname, summary in zip(missing, ex.map(summarize_document, (docs[f] for f in missing))):
+                summaries[fname] = summary
+    return {fname: summaries[fname] for fname in docs}
+
 def suggest_docs_for_stage(stage: str) -> str:
     prompt = (
         f"{SYSTEM_STYLE}\n"
@@ -173,20 +474,43 @@ def suggest_docs_for_stage(stage: str) -> str:
 # ----------------------------
 # Weather (live via OpenWeather)
 # ----------------------------
+# Pooled HTTP session (retries transient 5xx) + short-lived cache of formatted replies keyed by city
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False),
+    ),
+)
+_WX = TTLCache(maxsize=256, ttl=300) if TTLCache else None
+_WX_LOCK = threading.Lock()  # TTLCache isn't thread-safe; Streamlit sessions share it
+
 def get_weather(city: str) -> str:
     if not OPENWEATHER_API_KEY:
         return "🌦 Live weather unavailable (no OPENWEATHER_API_KEY set)."
+    key = city.strip().lower()
+    if _WX is not None:
+        with _WX_LOCK:
+            cached = _WX.get(key)
+        if cached is not None:
+            return cached
     try:
         url = "https://api.openweathermap.org/data/2.5/weather"
         params = {"q": city, "appid": OPENWEATHER_API_KEY, "units": "metric"}
-        r = requests.get(url, params=params, timeout=12)
+        r = _SESSION.get(url, params=params, timeout=12)
         if r.status_code == 200:
             data = r.json()
             weather = data["weather"][0]["description"].title()
             temp = data["main"]["temp"]
             wind = data["wind"]["speed"]
             hum = data["main"].get("humidity", "?")
-            return f"🌦 **{city.title()}** — {weather} • 🌡 {temp}°C • 💨 {wind} m/s • 💧 {hum}% RH"
+            formatted = f"🌦 **{city.title()}** — {weather} • 🌡 {temp}°C • 💨 {wind} m/s • 💧 {hum}% RH"
+            if _WX is not None:
+                with _WX_LOCK:
+                    _WX[key] = formatted
+            return formatted
         return f"⚠️ Could not fetch weather for **{city}** (HTTP {r.status_code})."
     except Exception as e:
         return f"⚠️ Weather API error: {e}"
@@ -194,47 +518,110 @@ def get_weather(city: str) -> str:
 # ----------------------------
 # Hybrid chat router
 # ----------------------------
-def answer_query(user_message: str, chat_history: Optional[List[Dict[str, str]]] = None) -> str:
+HISTORY_MESSAGES = 8
+HISTORY_MSG_CHARS = 300
+
+# Canned routing notes for port pairs we can classify; anything else gets a neutral note
+_SUEZ_PAIRS = {
+    frozenset(p) for p in [
+        ("rotterdam", "mumbai"), ("rotterdam", "dubai"), ("rotterdam", "singapore"),
+        ("rotterdam", "shanghai"), ("new york", "mumbai"), ("new york", "dubai"),
+        ("new york", "singapore"),
+    ]
+}
+_PANAMA_PAIRS = {
+    frozenset(p) for p in [
+        ("new york", "shanghai"), ("new york", "los angeles"), ("rotterdam", "los angeles"),
+    ]
+}
+
+def _routing_note(a: str, b: str) -> str:
+    pair = frozenset((a, b))
+    if pair in _SUEZ_PAIRS:
+        return "typically via Suez Canal; Cape of Good Hope is the longer alternative."
+    if pair in _PANAMA_PAIRS:
+        return "typically via Panama Canal; check draft/beam limits for the locks."
+    return "check canal/strait constraints for the chosen route."
+
+def answer_query(
+    user_message: str,
+    chat_history: Optional[List[Dict[str, str]]] = None,
+    stream: bool = False,
+) -> Union[str, Iterator[str]]:
     """
     - Weather queries → live API
-    - Distance queries → offline haversine + Gemini narrative
+    - Distance queries → offline haversine + ETA (Gemini narrative only on "explain"/"advice")
     - Everything else → Gemini (if available) else graceful offline note
-    Returns: text_response
+    Returns: text_response (Gemini-backed replies are an iterator of chunks when stream=True)
     """
     q = user_message.strip()
     ql = q.lower()
+    tags, ports = scan_keywords(ql)
 
     # Weather intent (extract city words after 'in' or end)
-    if "weather" in ql or "forecast" in ql:
-        m = re.search(r"(?:in|at)\s+([a-zA-Z\s\-]+)$", q, re.IGNORECASE)
+    if "wx" in tags:
+        m = _RE_WX_IN.search(q)
         if m:
             city = m.group(1).strip(" .!?,")
             return get_weather(city)
-        tokens = [t for t in re.split(r"[^A-Za-z\-]+", q) if t]
+        tokens = [t for t in _RE_TOK.split(q) if t]
         if tokens:
             return get_weather(tokens[-1])
         return get_weather("Singapore")
 
-    # Distance intent
-    a, b = parse_distance_query(q)
+    # Distance intent: "distance" plus exactly two known ports → use them in message order;
+    # otherwise fall back to the "distance between/from X and/to Y" shape, then regex parse
+    a, b = "", ""
+    m = None
+    if "dist" in tags and len(ports) == 2:
+        a, b = ports[0][1], ports[1][1]
+    elif "port" in tags and "dist" in tags:
+        m = _RE_DIST1.search(ql)
+    if m:
+        (s1, e1), (s2, e2) = m.span(1), m.span(2)
+        origin = [p for i, p in ports if s1 <= i and i + len(p) <= e1]
+        dest = [p for i, p in ports if s2 <= i and i + len(p) <= e2]
+        if origin and dest:
+            a, b = origin[0], dest[0]
+    if not (a and b):
+        a, b = parse_distance_query(q)
     if a and b and a in PORTS and b in PORTS:
         lat1, lon1 = PORTS[a]; lat2, lon2 = PORTS[b]
         nm = haversine_nm(lat1, lon1, lat2, lon2)
+        eta12 = nm / 12; eta14 = nm / 14
+        reply = (
+            f"**{a.title()} → {b.title()}**\n"
+            f"- Great-circle: {nm:,.0f} nm (lower bound; sea routing is longer)\n"
+            f"- ETA @12kn: {eta12:.0f} h ({eta12/24:.1f} d)\n"
+            f"- ETA @14kn: {eta14:.0f} h ({eta14/24:.1f} d)\n"
+            f"- Routing note: {_routing_note(a, b)}\n"
+            f"- Fuel: plan bunkers on actual routed distance plus weather/safety margin."
+        )
+        # Only pay a Gemini round-trip when the user asks for analysis
+        if "explain" not in ql and "advice" not in ql:
+            return iter([reply]) if stream else reply
         prompt = (
             f"{SYSTEM_STYLE}\n"
-            f"User asked distance between {a.title()} and {b.title()}.\n"
-            f"Great-circle distance (approx): {nm:,.0f} nautical miles.\n\n"
-            f"Now add: routing note (Suez/Cape if relevant), ETA at 12/14 knots, "
-            f"and a brief fuel planning reminder."
+            f"User asked: {q}\n"
+            f"Computed locally:\n{reply}\n\n"
+            f"Add brief voyage advice: routing trade-offs (Suez/Cape if relevant), "
+            f"weather/seasonal risks, and fuel planning."
         )
-        return _gen(prompt)
+        if stream:
+            return itertools.chain([reply + "\n\n"], _gen(prompt, stream=True))
+        return f"{reply}\n\n{_gen(prompt)}"
 
     # Generic maritime Q&A via Gemini
     history_text = ""
     if chat_history:
-        for m in chat_history[-8:]:
+        for m in chat_history[-HISTORY_MESSAGES:]:
             role = m.get("role", "user")
             content = m.get("content", "")
+            # Document summaries are long and already reflected in the docs; skip them
+            if role == "assistant" and content.startswith("**Summary for"):
+                continue
+            if len(content) > HISTORY_MSG_CHARS:
+                content = content[:HISTORY_MSG_CHARS] + "…"
             history_text += f"{role.upper()}: {content}\n"
 
     prompt = (
@@ -243,8 +630,12 @@ def answer_query(user_message: str, chat_history: Optional[List[Dict[str, str]]]
         f"USER: {q}\n\n"
         f"Respond now with clear sections and bullet points if helpful."
     )
-    return _gen(prompt)
+    return _gen(prompt, stream=stream)
 
 # Convenience name kept from your earlier code
-def hybrid_response(query: str, chat_history: Optional[List[Dict[str, str]]] = None) -> str:
-    return answer_query(query, chat_history=chat_history)
\ No newline at end of file
+def hybrid_response(
+    query: str,
+    chat_history: Optional[List[Dict[str, str]]] = None,
+    stream: bool = False,
+) -> Union[str, Iterator[str]]:
+    return answer_query(query, chat_history=chat_history, stream=stream)
\ No newline at end of file
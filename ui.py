@@ -3,11 +3,27 @@
 import os
 import streamlit as st
 import time
+import html
+import re
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Markdown → sanitized HTML for chat bubbles (falls back to escaped plain text)
+try:
+    import markdown as md
+    import nh3
+except Exception:
+    md = None
+    nh3 = None
 
 from main import (
     hybrid_response,
     read_text_from_file,
     summarize_document,
+    summarize_documents_batch,
+    is_gen_failure,
+    BATCH_DOC_CHARS,
+    GEN_MAX_CONCURRENCY,
     suggest_docs_for_stage,
 )
 
@@ -16,160 +32,29 @@ st.set_page_config(page_title="Maritime AI Assistant", page_icon="⚓", layout="
 # -----------------------------
 # Custom CSS (95% scale + narrowed & left-shifted chat_input)
 # -----------------------------
-st.markdown("""
-<style>
-/* Scale the entire app to 95% */
-body > div[role="main"] {
-    transform: scale(0.95);
-    transform-origin: top left;
-}
-
-/* General body and font styles */
-body {
-    font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, "Helvetica Neue", Arial, sans-serif;
-}
-
-/* Main content container styling */
-.main .block-container {
-    padding-top: 0.5rem;  
-    padding-bottom: 2rem;
-    max-width: 1200px;
-    margin: 0 auto;
-}
-
-/* Cards for the left panel */
-.stContainer {
-    border: none !important;
-    background-color: transparent !important;
-}
-
-.card {
-    background: #ffffff;
-    border: 1px solid #e0e0e0;
-    border-radius: 12px;
-    padding: 20px;
-    box-shadow: 0 4px 12px rgba(0,0,0,0.05);
-    margin-bottom: 20px;
-}
-.card h4 {
-    margin-top: 0;
-    font-weight: 600;
-    color: #333;
-}
-
-/* Chat bubbles and chat container */
-.chat-container {
-    height: 60vh; 
-    overflow-y: auto; 
-    padding-right: 15px; 
-    padding-bottom: 15px; 
-}
-
-.chat-bubble {
-    padding: 15px 19px;
-    border-radius: 19px;
-    margin: 9px 0;
-    max-width: 80%;
-    white-space: pre-wrap;
-    line-height: 1.4;
-    font-size: 0.95rem;
-}
-.user {
-    background: #007bff;
-    color: white;
-    margin-left: auto;
-    border-bottom-right-radius: 5px;
-}
-.assistant {
-    background: #f0f2f6;
-    border: 1px solid #e0e0e0;
-    color: #333;
-    border-bottom-left-radius: 5px;
-}
-
-/* Input row styling (for general inputs, not chat_input) */
-.input-wrap {
-    max-width: 855px;
-    margin: 0.95rem auto 0;
-}
-.stTextInput > div > div {
-    max-width: 600px !important;  
-    margin: 0 auto;  
-}
-.stTextInput > div > div > input {
-    width: 100% !important;  
-    border-radius: 23px;
-    border: 1px solid #ccc;
-    padding: 9.5px 13.5px;
-    font-size: 0.95rem;
-}
-
-/* Streamlit chat_input box at the bottom, narrowed & slightly left-shifted */
-[data-testid="stChatInput"] {
-    display: flex !important;
-    justify-content: flex-end !important;
-    padding-right: 50px;  /* adjust spacing from right */
-}
-[data-testid="stChatInput"] > div {
-    max-width: 600px !important;  
-    width: 100% !important;
-    transform: translateX(-110px);  /* move slightly left */
-}
-[data-testid="stChatInput"] input {
-    width: 100% !important;
-    padding: 10px 14px;
-    font-size: 0.95rem;
-    border-radius: 23px;
-}
+CSS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".streamlit", "style.css")
 
-/* Header and captions */
-h1 { 
-    font-weight: 800; 
-    color: #1a237e; 
-    font-size: 2.375rem; 
-    margin-top: 0.2rem;  
-    margin-bottom: 0.2rem;
-}
-.st-emotion-cache-1avcm0n p {
-    color: #6c757d;
-    font-size: 0.9rem;
-}
+@st.cache_resource(show_spinner=False)
+def _load_css() -> str:
+    """Read the stylesheet once per server process."""
+    with open(CSS_PATH, encoding="utf-8") as fh:
+        return fh.read()
 
-/* Buttons */
-.stButton button {
-    border-radius: 7.5px;
-    padding: 9.5px 14px;
-    font-weight: 600;
-    font-size: 0.95rem;
-    transition: background-color 0.3s ease;
-}
-.stButton button[kind="secondary"] {
-    background: #f0f2f6;
-    border: 1px solid #e0e0e0;
-    color: #333;
-}
-.stButton button[kind="secondary"]:hover {
-    background: #e0e0e0;
-}
-.stButton button[kind="primary"] {
-    background: #007bff;
-    color: white;
-    border: none;
-}
-.stButton button[kind="primary"]:hover {
-    background: #0056b3;
-}
+# Streamlit drops elements not re-emitted on a full rerun, so the <style> tag is still
+# written each run; fragment reruns (chat) skip it entirely.
+st.markdown(f"<style>\n{_load_css()}</style>", unsafe_allow_html=True)
 
-/* Minor component tweaks */
-.stSelectbox div[data-baseweb="select"] {
-    border-radius: 7.5px;
-}
-.stFileUploader div[data-baseweb="file-uploader"] {
-    border-radius: 7.5px;
-}
-</style>
-""", unsafe_allow_html=True)
 
+# -----------------------------
+# Cached helpers
+# -----------------------------
+@st.cache_data(show_spinner=False, max_entries=64)
+def read_text_from_file_cached(name: str, content_bytes: bytes, _procs=None) -> str:
+    """Parse once per (name, bytes); re-uploads of identical files hit the cache.
+    With _procs (not part of the cache key), parsing runs in that process pool."""
+    if _procs is not None:
+        return _procs.submit(read_text_from_file, name, content_bytes).result()
+    return read_text_from_file(name, content_bytes)
 
 # -----------------------------
 # Session State
@@ -180,17 +65,59 @@ if "chat" not in st.session_state:
     ]
 if "uploads" not in st.session_state:
     st.session_state.uploads = {}
+if "uploads_meta" not in st.session_state:
+    st.session_state.uploads_meta = {}  # filename -> (size, md5 of first 4KB)
 
 # -----------------------------
 # Core chat processing function
 # -----------------------------
-def handle_user_query(user_query: str):
-    """Adds user query to chat and gets assistant response."""
+_BUBBLE_TAGS = {
+    "p", "br", "strong", "b", "em", "i", "code", "pre", "blockquote", "hr",
+    "ul", "ol", "li", "h1", "h2", "h3", "h4", "h5", "h6",
+    "table", "thead", "tbody", "tr", "th", "td", "a",
+}
+_BUBBLE_ATTRS = {"a": {"href", "title"}}
+# Python-Markdown needs a blank line before a list; chat replies often omit it
+_RE_LIST_AFTER_TEXT = re.compile(r"^(?![ \t]*(?:[-*+]|\d+\.)[ \t])(.+)\n(?=[ \t]*(?:[-*+]|\d+\.)[ \t])", re.M)
+
+def _bubble_html(content: str) -> str:
+    """Render message markdown to HTML and strip anything outside a small allowlist
+    (content is user/LLM text, so raw HTML must not pass through)."""
+    if md is None or nh3 is None:
+        return html.escape(content)
+    rendered = md.markdown(_RE_LIST_AFTER_TEXT.sub(r"\1\n\n", content), extensions=["extra", "sane_lists", "nl2br"])
+    return nh3.clean(
+        rendered, tags=_BUBBLE_TAGS, attributes=_BUBBLE_ATTRS,
+        url_schemes={"http", "https", "mailto"},
+    )
+
+def chat_bubble(role: str, content: str, plain: bool = False) -> str:
+    """Bubble HTML for one message. Newlines are encoded so blank lines don't end the
+    HTML block when bubbles are joined into one markdown element.
+    plain=True skips markdown and just escapes (cheap enough to redo per streamed chunk)."""
+    css = "user" if role == "user" else "assistant"
+    rich = " md" if not plain and md is not None and nh3 is not None else ""
+    body = (_bubble_html(content) if rich else html.escape(content)).replace("\n", "&#10;")
+    return f'<div class="chat-bubble {css}{rich}">{body}</div>'
+
+def handle_user_query(user_query: str, chat_container):
+    """Adds user query to chat and streams the assistant response into the chat container."""
     st.session_state.chat.append({"role": "user", "content": user_query})
-    with st.spinner("Thinking..."):
-        reply = hybrid_response(user_query, chat_history=st.session_state.chat)
-    st.session_state.chat.append({"role": "assistant", "content": reply})
-    st.rerun()
+    with chat_container:
+        st.markdown(chat_bubble("user", user_query), unsafe_allow_html=True)
+        placeholder = st.empty()
+        # Spinner only until the first chunk arrives; streaming text replaces it
+        with st.spinner("Thinking..."):
+            reply = hybrid_response(user_query, chat_history=st.session_state.chat, stream=True)
+            if isinstance(reply, str):
+                reply = iter([reply])
+            text = next(reply, "")
+        placeholder.markdown(chat_bubble("assistant", text, plain=True), unsafe_allow_html=True)
+        for chunk in reply:
+            text += chunk
+            placeholder.markdown(chat_bubble("assistant", text, plain=True), unsafe_allow_html=True)
+        placeholder.markdown(chat_bubble("assistant", text), unsafe_allow_html=True)
+    st.session_state.chat.append({"role": "assistant", "content": text.strip()})
 
 # -----------------------------
 # Header (shifted to top)
@@ -215,11 +142,36 @@ with left:
     )
 
     if uploaded_files:
-        with st.spinner("Processing files..."):
-            for f in uploaded_files:
-                content_bytes = f.read()
-                text = read_text_from_file(f.name, content_bytes)
-                st.session_state.uploads[f.name] = text
+        # Only parse files not already processed this session (reruns re-deliver the same uploads)
+        new_files = []
+        for f in uploaded_files:
+            f.seek(0)
+            meta = (f.size, hashlib.md5(f.read(4096)).hexdigest())
+            f.seek(0)
+            if f.name in st.session_state.uploads and st.session_state.uploads_meta.get(f.name) == meta:
+                continue
+            new_files.append((f, meta))
+
+        if new_files:
+            with st.spinner("Processing files..."):
+                # Read bytes on the main thread; parse in parallel. PDFium calls are serialized
+                # per process, so several PDFs fan out to worker processes instead of threads.
+                raw = [(f.name, f.read()) for f, _ in new_files]
+                is_pdf = [name.lower().endswith(".pdf") for name, _ in raw]
+                n_pdf = sum(is_pdf)
+                procs = ProcessPoolExecutor(max_workers=min(n_pdf, os.cpu_count() or 1)) if n_pdf > 1 else None
+                try:
+                    with ThreadPoolExecutor(max_workers=min(GEN_MAX_CONCURRENCY, len(raw))) as ex:
+                        texts = list(ex.map(
+                            lambda item, pdf: read_text_from_file_cached(*item, _procs=procs if pdf else None),
+                            raw, is_pdf,
+                        ))
+                finally:
+                    if procs is not None:
+                        procs.shutdown()
+                for (f, meta), text in zip(new_files, texts):
+                    st.session_state.uploads[f.name] = text
+                    st.session_state.uploads_meta[f.name] = meta
         st.success(f"Successfully uploaded {len(uploaded_files)} file(s).")
 
     colA, colB = st.columns(2)
@@ -230,15 +182,28 @@ with left:
 
     if summarize_clicked and st.session_state.uploads:
         with st.spinner("Generating summaries..."):
-            for fname, txt in st.session_state.uploads.items():
-                summary = summarize_document(txt)
-                st.session_state.chat.append(
-                    {"role": "assistant", "content": f"**Summary for _{fname}_**\n\n{summary}"}
-                )
-            st.success("Summaries added to chat.")
+            docs = st.session_state.uploads
+            if all(len(txt) <= BATCH_DOC_CHARS for txt in docs.values()):
+                summaries = summarize_documents_batch(docs)
+            else:
+                # Long docs would be clipped in a batch; summarize each one concurrently instead
+                with ThreadPoolExecutor(max_workers=min(GEN_MAX_CONCURRENCY, len(docs))) as ex:
+                    summaries = dict(zip(docs.keys(), ex.map(summarize_document, docs.values())))
+            distinct = set(summaries.values())
+            if len(distinct) == 1 and is_gen_failure(next(iter(distinct))):
+                # Same failure for every file (e.g. the batch call failed): say it once
+                st.session_state.chat.append({"role": "assistant", "content": next(iter(distinct))})
+                st.warning("Could not generate summaries.")
+            else:
+                for fname, summary in summaries.items():
+                    st.session_state.chat.append(
+                        {"role": "assistant", "content": f"**Summary for _{fname}_**\n\n{summary}"}
+                    )
+                st.success("Summaries added to chat.")
 
     if clear_clicked:
         st.session_state.uploads = {}
+        st.session_state.uploads_meta = {}
         st.toast("Cleared uploaded docs")
         st.rerun()
 
@@ -266,21 +231,25 @@ with left:
     st.markdown('</div>', unsafe_allow_html=True)
 
 
-with right:
-    st.markdown("### 💬 Chat")
-    
+@st.fragment
+def render_chat():
+    """Chat panel + input; submitting a message reruns only this fragment, not the whole page."""
     chat_container = st.container(height=500)
     with chat_container:
-        for m in st.session_state.chat:
-            role = m.get("role", "assistant")
-            content = m.get("content", "")
-            css = "user" if role == "user" else "assistant"
-            st.markdown(f'<div class="chat-bubble {css}">{content}</div>', unsafe_allow_html=True)
+        # One markdown element for the whole history instead of one per message
+        bubbles = "".join(
+            chat_bubble(m.get("role", "assistant"), m.get("content", ""))
+            for m in st.session_state.chat
+        )
+        st.markdown(bubbles, unsafe_allow_html=True)
+
+    user_query = st.chat_input(
+        "Ask about laytime, CP clauses, weather, or distances...",
+        key="chat_in"
+    )
+    if user_query:
+        handle_user_query(user_query, chat_container)
 
-# Chat input fixed at bottom
-user_query = st.chat_input(
-    "Ask about laytime, CP clauses, weather, or distances...",
-    key="chat_in"
-)
-if user_query:
-    handle_user_query(user_query)
+with right:
+    st.markdown("### 💬 Chat")
+    render_chat()